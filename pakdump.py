@@ -1,6 +1,10 @@
 #!/usr/bin/env python3
-from struct import unpack, calcsize
-import png
+from struct import unpack, Struct
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from PIL import Image
+import numpy as np
+import mmap
 import sys
 import os
 
@@ -8,7 +12,66 @@ def verify (cond, msg):
 	if not cond:
 		raise Exception (msg)
 
-def pvr_decode (data):
+#Colour decoders...
+#Integer only so they can run over whole numpy arrays of pixels
+#Channels are widened to 8 bits by replicating their top bits into the low ones,
+#which maps 0 to 0 and full intensity to 255 like the hardware does
+def unpack1555 (colour):
+	a = 255*((colour>>15)&1)
+	r = (colour>>10)&31
+	g = (colour>> 5)&31
+	b = (colour    )&31
+	return [(r<<3)|(r>>2), (g<<3)|(g>>2), (b<<3)|(b>>2), a]
+	
+def unpack4444 (colour):
+	a = (colour>>12)&15
+	r = (colour>> 8)&15
+	g = (colour>> 4)&15
+	b = (colour    )&15
+	return [(r<<4)|r, (g<<4)|g, (b<<4)|b, (a<<4)|a]
+
+def unpack565 (colour):
+	r = (colour>>11)&31
+	g = (colour>> 5)&63
+	b = (colour    )&31
+	return [(r<<3)|(r>>2), (g<<2)|(g>>4), (b<<3)|(b>>2)]
+
+#Runs a colour decoder over every possible 16 bit pixel,
+#so decoding an image becomes a single table lookup
+def build_lut (decoder):
+	return np.stack (decoder (np.arange (0x10000, dtype = np.uint32)), -1).astype (np.uint8)
+
+LUT_1555 = build_lut (unpack1555)
+LUT_4444 = build_lut (unpack4444)
+LUT_565 = build_lut (unpack565)
+
+#This is my favourite black magic spell!
+#Interleaves x and y to produce a morton code
+#This trivialises decoding PVR images
+#Works equally on ints and numpy arrays, which broadcast to a full index table
+def morton (x, y):
+	x = (x|(x<<8))&0x00ff00ff
+	y = (y|(y<<8))&0x00ff00ff
+	x = (x|(x<<4))&0x0f0f0f0f
+	y = (y|(y<<4))&0x0f0f0f0f
+	x = (x|(x<<2))&0x33333333
+	y = (y|(y<<2))&0x33333333
+	x = (x|(x<<1))&0x55555555	
+	y = (y|(y<<1))&0x55555555
+	return x|(y<<1)
+
+#Morton codes for every pixel of a h by w grid, computed as array operations
+#The interleave is separable, so only h + w values are ever spread out
+#Archives reuse a handful of sizes, so tables are cached and shared read only
+@lru_cache (maxsize = 32)
+def morton_table (h, w):
+	rows = np.arange (h, dtype = np.uint32)
+	cols = np.arange (w, dtype = np.uint32)
+	table = morton (rows[:, None], cols[None, :])
+	table.flags.writeable = False
+	return table
+
+def pvr_decode (data, name):
 	#Some PVR constants
 	HEADER_SIZE = 16
 	CODEBOOK_SIZE = 2048
@@ -72,8 +135,12 @@ def pvr_decode (data):
 		'SQUARE TWIDDLED MIPMAP ALT'
 	]
 	
+	#Work on a view so trimming the texture and slicing out its largest mipmap
+	#never copies the smaller levels along with it
+	data = memoryview (data)
+	
 	#Ensure the texture is PVR encoded
-	if data[:4].decode ('ASCII', 'ignore') != 'PVRT':
+	if bytes (data[:4]) != b'PVRT':
 		return 'Not a PVR texture!', ''
 	
 	#Extract header
@@ -82,53 +149,26 @@ def pvr_decode (data):
 	data = data[:8 + total]
 
 	#Print info and verify
-	print (f'    Type: {TYPES[px]} {FMTS[fmt]}, Size: {width}x{height}')
+	#Textures decode on worker threads, so say which one this is
+	print (f'    "{name}" Type: {TYPES[px]} {FMTS[fmt]}, Size: {width}x{height}')
 	verify (width < MAX_WIDTH, f'width is {width}; must be < {MAX_WIDTH}')
 	verify (height < MAX_HEIGHT, f'height is {height}; must be < {MAX_HEIGHT}')
 	
-	#This is my favourite black magic spell!
-	#Interleaves x and y to produce a morton code
-	#This trivialises decoding PVR images
-	def morton (x, y):
-		x = (x|(x<<8))&0x00ff00ff
-		y = (y|(y<<8))&0x00ff00ff
-		x = (x|(x<<4))&0x0f0f0f0f
-		y = (y|(y<<4))&0x0f0f0f0f
-		x = (x|(x<<2))&0x33333333
-		y = (y|(y<<2))&0x33333333
-		x = (x|(x<<1))&0x55555555	
-		y = (y|(y<<1))&0x55555555
-		return x|(y<<1)
-	
-	#Colour decoders...
-	def unpack1555 (colour):
-		a = int (255*((colour>>15)&31))
-		r = int (255*((colour>>10)&31)/31.0)
-		g = int (255*((colour>> 5)&31)/31.0)
-		b = int (255*((colour    )&31)/31.0)
-		return [r, g, b, a]
-		
-	def unpack4444 (colour):
-		a = int (255*((colour>>12)&15)/15.0)
-		r = int (255*((colour>> 8)&15)/15.0)
-		g = int (255*((colour>> 4)&15)/15.0)
-		b = int (255*((colour    )&15)/15.0)
-		return [r, g, b, a]
-	
-	def unpack565 (colour):
-		r = int (255*((colour>>11)&31)/31.0)
-		g = int (255*((colour>> 5)&63)/63.0)
-		b = int (255*((colour    )&31)/31.0)
-		return [r, g, b]
-	
 	#Format decoders...
 	#GOTCHA: PVR stores mipmaps from smallest to largest!
-	def vq_decode (raw, decoder):
-		pix = []
+	def vq_decode (raw, lut):
+		#Extract the codebook and decode all of its pixels at once
+		#The codebook is a 2x2 block of 16 bit pixels, stored column by column,
+		#so swap the last two axes to get each block as [row][column]
+		book = raw[HEADER_SIZE : HEADER_SIZE + CODEBOOK_SIZE]
+		book = lut[np.frombuffer (book, '<u2')]
+		book = book.reshape (256, 2, 2, -1).transpose (0, 2, 1, 3)
 		
-		#Extract the codebook
-		tmp = raw[HEADER_SIZE:]
-		book = unpack (f'<1024H', tmp[:CODEBOOK_SIZE])
+		#Pack each row of a block into a single opaque item,
+		#so a lookup moves both of its pixels in one copy
+		#Split into a top and bottom row table, one per output line of a block
+		book = np.ascontiguousarray (book).reshape (256, 2, -1)
+		book = book.view (f'V{book.shape[2]}')[..., 0].T.copy ()
 		
 		#Skip to the largest mipmap
 		#NB: This also avoids another gotcha:
@@ -136,111 +176,122 @@ def pvr_decode (data):
 		#Since we only want the largest though, it doesn't affect us
 		size = len (raw)
 		base = width*height//4
-		lut = raw[size - base : size]
+		indices = np.frombuffer (raw[size - base : size], np.uint8)
 		
-		#The codebook is a 2x2 block of 16 bit pixels
-		#This effectively halves the image dimensions
 		#Each index of the data refers to a codebook entry
-		for i in range (height//2):
-			row0 = []
-			row1 = []
-			for j in range (width//2):
-				entry = 4*lut[morton (i, j)]
-				row0.extend (decoder (book[entry + 0]))
-				row1.extend (decoder (book[entry + 1]))
-				row0.extend (decoder (book[entry + 2]))
-				row1.extend (decoder (book[entry + 3]))
-			pix.append (row0)
-			pix.append (row1)
-		return pix
-	
-	def morton_decode (raw, decoder):
-		pix = []
+		#This effectively halves the image dimensions
+		indices = indices[morton_table (height//2, width//2)]
 		
+		#Gather the top and bottom block rows straight into alternate lines
+		#of the output, so the blocks are never reshuffled afterwards
+		pix = np.empty ((height//2, 2, width//2), book.dtype)
+		for r in range (2):
+			np.take (book[r], indices, out = pix[:, r])
+		
+		#Unpack back to one row of bytes per line
+		return pix.view (np.uint8).reshape (height, -1)
+	
+	def morton_decode (raw, lut):
 		#Skip to largest mipmap
 		size = len (raw)
 		base = width*height*2
 		mip = raw[size - base : size]
 		
-		data = unpack (f'<{width*height}H', mip)
+		#Gather and decode one row at a time straight into the output buffer,
+		#so the intermediate pixels never leave the cache
+		data = np.frombuffer (mip, '<u2')
+		index = morton_table (height, width)
+		pix = np.empty ((height, width, lut.shape[1]), np.uint8)
 		for i in range (height):
-			row = []
-			for j in range (width):
-				row.extend (decoder (data[morton (i, j)]))
-			pix.append (row)
-		return pix
+			np.take (lut, data[index[i]], axis = 0, out = pix[i])
+		
+		#Flatten the channels to get one row of bytes per line
+		return pix.reshape (height, -1)
 	
 	#From observation:
 	#All textures 16 bit
 	#All textures are either VQ'd or morton coded (twiddled)
 	#So let's just save time and only implement those
-	if ARGB1555 == px:
-		if SQUARE_TWIDDLED == fmt or SQUARE_TWIDDLED_MIPMAP == fmt:
-			return morton_decode (data, unpack1555), 'RGBA'
-		elif VQ == fmt or VQ_MIPMAP == fmt:
-			return vq_decode (data, unpack1555), 'RGBA'
-	elif ARGB4444 == px:
-		if SQUARE_TWIDDLED == fmt or SQUARE_TWIDDLED_MIPMAP == fmt:
-			return morton_decode (data, unpack4444), 'RGBA'
-		elif VQ == fmt or VQ_MIPMAP == fmt:
-			return vq_decode (data, unpack4444), 'RGBA'
-	elif RGB565 == px:
-		if SQUARE_TWIDDLED == fmt or SQUARE_TWIDDLED_MIPMAP == fmt:
-			return morton_decode (data, unpack565), 'RGB'
-		elif VQ == fmt or VQ_MIPMAP == fmt:
-			return vq_decode (data, unpack565), 'RGB'
+	#Each pixel type is baked into its own lookup table, so a texture only needs
+	#one lookup here to pick its decoder, table and output mode
+	DECODERS = {
+		(ARGB1555, SQUARE_TWIDDLED)       : (morton_decode, LUT_1555, 'RGBA'),
+		(ARGB1555, SQUARE_TWIDDLED_MIPMAP): (morton_decode, LUT_1555, 'RGBA'),
+		(ARGB1555, VQ)                    : (vq_decode, LUT_1555, 'RGBA'),
+		(ARGB1555, VQ_MIPMAP)             : (vq_decode, LUT_1555, 'RGBA'),
+		(ARGB4444, SQUARE_TWIDDLED)       : (morton_decode, LUT_4444, 'RGBA'),
+		(ARGB4444, SQUARE_TWIDDLED_MIPMAP): (morton_decode, LUT_4444, 'RGBA'),
+		(ARGB4444, VQ)                    : (vq_decode, LUT_4444, 'RGBA'),
+		(ARGB4444, VQ_MIPMAP)             : (vq_decode, LUT_4444, 'RGBA'),
+		(RGB565, SQUARE_TWIDDLED)         : (morton_decode, LUT_565, 'RGB'),
+		(RGB565, SQUARE_TWIDDLED_MIPMAP)  : (morton_decode, LUT_565, 'RGB'),
+		(RGB565, VQ)                      : (vq_decode, LUT_565, 'RGB'),
+		(RGB565, VQ_MIPMAP)               : (vq_decode, LUT_565, 'RGB')
+	}
+	if (px, fmt) in DECODERS:
+		decoder, lut, mode = DECODERS[(px, fmt)]
+		return decoder (data, lut), mode
 	
 	#Oh, well...
 	return 'Unsupported encoding', ''
 		
-def uncompress (data, extra):
-	SIZE = 4096
-	MASK = SIZE - 1
-	
+def uncompress (data, extra, size):
 	extra += 1
-	ring = SIZE*[0]
-	r = 0
 	
-	out = []
+	#The header tells us the final size, so write into a buffer of that size
+	#It also serves as the 4k window, so there is no separate ring buffer
+	out = bytearray (size)
+	r = 0
 	pos = 0
+	end = len (data)
 	
-	ctl = 0
-	while pos < len (data):
-		if 0 == (ctl&256):
-			if pos >= len (data):
-				break
-			ctl = data[pos]
-			ctl |= 0xff00
-			pos += 1
-		
-		#If bit is set then next byte in payload is a literal,
-		#else it is a 12 bit offset, 4 bit length pair into a 4k ring buffer
-		if ctl&1:
-			c = data[pos]
-			out.append (c)
-			ring[r&MASK] = c
-			pos += 1
-			r += 1
-		else:
-			if pos >= len (data):
+	while pos < end:
+		#Each control byte describes the next 8 items of the payload
+		ctl = data[pos]
+		pos += 1
+		for bit in range (8):
+			if pos >= end:
 				break
-			b0 = data[pos + 0]
-			b1 = data[pos + 1]
-			word = (b1<<8)|b0
-			base = (word>>4)&0xfff
-			length = (word&0xf) + extra
-			offset = r - (base + 1)
 			
-			for i in range (length):
-				c = ring[(offset + i)&MASK]
-				out.append (c)
-				ring[r&MASK] = c
+			#If bit is set then next byte in payload is a literal,
+			#else it is a 12 bit offset, 4 bit length pair into a 4k window
+			if ctl&1:
+				#Overruns still grow the output, so the caller can report the entry
+				if r < size:
+					out[r] = data[pos]
+				else:
+					out.append (data[pos])
+				pos += 1
 				r += 1
-			
-			pos += 2
-		#Advance to the next bit
-		ctl >>= 1
+			else:
+				word = (data[pos + 1]<<8)|data[pos]
+				base = (word>>4)&0xfff
+				length = (word&0xf) + extra
+				offset = r - (base + 1)
+				
+				#Anything before the start of the output reads as zero
+				if offset < 0:
+					n = min (-offset, length)
+					out[r:r + n] = bytes (n)
+					offset += n
+					length -= n
+					r += n
+				
+				#Copy the match as a slice; a match that overlaps itself
+				#repeats the last base + 1 bytes, so copy whole repeats of those
+				span = base + 1
+				if length <= span:
+					out[r:r + length] = out[offset:offset + length]
+				else:
+					out[r:r + length] = (out[offset:r]*(length//span + 1))[:length]
+				r += length
+				
+				pos += 2
+			#Advance to the next bit
+			ctl >>= 1
 	
+	#Trim in case the payload came up short, so the caller can tell
+	del out[r:]
 	return bytes (out)
 
 def main (args):
@@ -254,80 +305,119 @@ def main (args):
 	#Load the manifest
 	split = os.path.splitext (args[1])
 	with open (split[0] + '.lst', 'rb') as f:
-		count = 0
 		lines = f.readlines ()
+	
+	#Build a list of files and where they go on disk, in one pass
+	root = os.path.join (DEST, os.path.basename (args[1]))
+	files = []
+	dirs = set ()
+	outputs = {}
+	for ln in lines:
+		#Remove blanks and comments
+		ln = ln.decode ('latin').strip ().lower ().replace ('\0', '').replace ('\\', '/')
+		if len (ln) < 2:
+			continue
+		if '' == ln:
+			continue
+		if '#' == ln[:1]:
+			continue
 		
-		#Build a list of files
-		files = []
-		for ln in lines:
-			#Remove blanks and comments
-			ln = ln.decode ('latin').strip ().lower ().replace ('\0', '').replace ('\\', '/')
-			if len (ln) < 2:
-				continue
-			if '' == ln:
-				continue
-			if '#' == ln[:1]:
-				continue
-			#Insert the path into the list for later
-			files.append (ln)
-			count += 1
+		#Drop the drive and rebuild path on disk
+		if ':' in ln:
+			ln = ln[ln.index (':') + 2:]
+		path = os.path.normpath (ln)
+		dn = os.path.join (root, os.path.dirname (path))
+		fn = os.path.basename (path)
+		
+		#Many files share a directory, so only note each one once
+		dirs.add (dn)
+		
+		#Insert the entry into the list for later
+		#Entries landing on the same file on disk are grouped, in manifest order
+		outputs.setdefault ((dn, fn), []).append (len (files))
+		files.append ((path, dn, fn))
+	count = len (files)
 	
-	#Build a path list...
-	paths = []
-	for p in files:
-		if ':' in p:
-			path = p[p.index (':') + 2:]
-		else:
-			path = p
-		sanitised = os.path.normpath (path)
-		paths.append (sanitised)
+	#Entry header: uncompressed size, compressed size, mode
+	HEADER = Struct ('<IIH')
 	
-	#Extract files from archive...
+	#Read and uncompress contents as needed
+	MODE_RAW = 0
+	MODE_UNK = 1
+	MODE_LZSS = 2
+	MODES = ['uncompressed', 'LZSS_ALT', 'LZSS']
+	
+	#Map the archive once; entries are sliced straight out of it without copying
+	#The mapping is released along with the last view into it
 	with open (args[1], 'rb') as f:
-		offsets = unpack (f'<{count}I', f.read (calcsize (f'<{count}I')))
-		for i in range (count):
-			#Rebuild path on disk
-			fn = os.path.basename (paths[i])
-			dn = os.path.join (DEST, os.path.basename (args[1]), os.path.dirname (paths[i]))
-			os.makedirs (dn, exist_ok = True)
-			
-			#Seek to find and read header
-			f.seek (offsets[i])
-			uncompressed, compressed, mode = unpack ('<IIH', f.read (calcsize ('<IIH')))
-			
-			#Read and uncompress contents as needed
-			MODE_RAW = 0
-			MODE_UNK = 1
-			MODE_LZSS = 2
+		mapping = mmap.mmap (f.fileno (), 0, access = mmap.ACCESS_READ)
+	
+	#Entries are stored, and mostly extracted, in order, so ask for aggressive read ahead
+	if hasattr (mmap, 'MADV_SEQUENTIAL'):
+		mapping.madvise (mmap.MADV_SEQUENTIAL)
+	archive = memoryview (mapping)
+	
+	#Extracts a single file, entries are independent so these run in parallel
+	def extract (offset, path, dn, fn):
+		#Read header, the payload follows immediately
+		uncompressed, compressed, mode = HEADER.unpack_from (archive, offset)
+		offset += HEADER.size
+		payload = archive[offset : offset + compressed]
+		
+		rate = 100*compressed/uncompressed
+		print (f'Uncompressing "{path}", ratio: {rate:.4}% ({MODES[mode]}) {uncompressed}')
+		if MODE_RAW == mode:
+			data = payload
+		elif MODE_UNK == mode or MODE_LZSS == mode:
+			#Indexing bytes is cheaper than indexing a view in the decode loop
+			data = uncompress (bytes (payload), mode, uncompressed)
+			verify (len (data) == uncompressed, f'"{path}" uncompressed to {len (data)} bytes, instead of {uncompressed}')
+		else:
+			raise Exception (f'Unknown compression mode {mode}')
 			
-			rate = 100*compressed/uncompressed
-			MODES = ['uncompressed', 'LZSS_ALT', 'LZSS']
-			print (f'Uncompressing "{paths[i]}", ratio: {rate:.4}% ({MODES[mode]}) {uncompressed}')
-			if MODE_RAW == mode:
-				data = f.read (compressed)
-			elif MODE_UNK == mode or MODE_LZSS == mode:
-				data = uncompress (f.read (compressed), mode)
-				verify (len (data) == uncompressed, f'"{paths[i]}" uncompressed to {len (data)} bytes, instead of {uncompressed}')
-			else:
-				raise Exception (f'Unknown compression mode {mode}')
+		if '.pvr' in path:
+			data = memoryview (data)[16:]
 				
-			if '.pvr' in paths[i]:
-				data = data[16:]
-					
-				ret, mode = pvr_decode (data)
-				try:
-					verify (str != type (ret), f'image "{paths[i]}" failed to decode: {ret}!')
-					png.from_array (ret, mode).save (os.path.join (dn, fn) + '.png')
-				except:
-					#Dump the image for examination
-					with open (os.path.join (dn, fn), 'wb') as out:
-						out.write (data)
-			else:	
-				#Write it to disk and free data
+			ret, mode = pvr_decode (data, path)
+			try:
+				verify (str != type (ret), f'image "{path}" failed to decode: {ret}!')
+				#Pillow's encoder is native; favour speed over file size
+				#The decoded rows are handed over in place rather than copied to bytes
+				size = (ret.shape[1]//len (mode), ret.shape[0])
+				image = Image.frombuffer (mode, size, ret, 'raw', mode, 0, 1)
+				image.save (os.path.join (dn, fn) + '.png', compress_level = 1)
+			except:
+				#Dump the image for examination
 				with open (os.path.join (dn, fn), 'wb') as out:
 					out.write (data)
+		else:	
+			#Write it to disk
+			with open (os.path.join (dn, fn), 'wb') as out:
+				out.write (data)
+	
+	#Extract files from archive...
+	offsets = Struct (f'<{count}I').unpack_from (archive)
+	
+	#The archive is readable, so create the directories before any entry needs them
+	for dn in dirs:
+		os.makedirs (dn, exist_ok = True)
+	
+	#Entries that share an output file are extracted one after another by the
+	#same worker, so the last one in the manifest wins as it always has
+	def extract_all (indices):
+		for i in indices:
+			extract (offsets[i], *files[i])
+	
+	with ThreadPoolExecutor (max_workers = os.cpu_count ()) as pool:
+		jobs = [pool.submit (extract_all, indices) for indices in outputs.values ()]
+		#Surface the first failure in manifest order; on any error or Ctrl-C,
+		#drop the queued entries so only those already in flight finish
+		try:
+			for job in jobs:
+				job.result ()
+		except BaseException:
+			pool.shutdown (wait = True, cancel_futures = True)
+			raise
 			
-			del data	
-				
 if __name__ == "__main__":
 	main (sys.argv)
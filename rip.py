@@ -1,5 +1,5 @@
 #!/usr/bin/env python3
-from struct import unpack, calcsize
+from struct import Struct
 import sys
 import os
 
@@ -13,21 +13,53 @@ def main (args):
 	#Start of ISO9660 FS
 	offset = int (args[2])
 
+	#Directory record: length, extent LBA, data length, flags, name length
+	#Only the little endian halves of the both-endian fields are read
+	RECORD = Struct ('<Bx I 4x I 11x B 6x B')
+
 	def read_dir (f):
-		base = f.tell ()
-		size = unpack ('b', f.read (1))[0]
-		f.seek (base + 2)
-		lba = 2048*(unpack ('<I', f.read (4))[0] - 11716)
-		f.seek (base + 10)
-		length = unpack ('<I', f.read (4))[0]
-		f.seek (base + 25)
-		flags = unpack ('b', f.read (1))[0]
-		f.seek (base + 32)
-		name_length = unpack ('b', f.read (1))[0]
+		size, lba, length, flags, name_length = RECORD.unpack (f.read (RECORD.size))
+		lba = 2048*(lba - 11716)
 		name = f.read (name_length).decode ('latin')
 		return size, lba, length, name_length, name, flags
 
+	#Copies length bytes of the image at start into d
+	#sendfile keeps the copy in the kernel; fall back to chunked reads without it
+	CHUNK = 1<<20
+	#Access pattern hints for the kernel, where the platform has them
+	ADVISE = hasattr (os, 'posix_fadvise')
+
+	def copy (f, d, start, length):
+		#Have the kernel start fetching the whole file before we ask for it
+		#A zero length would mean everything up to the end of the image
+		if ADVISE and length:
+			os.posix_fadvise (f.fileno (), start, length, os.POSIX_FADV_WILLNEED)
+
+		if hasattr (os, 'sendfile'):
+			try:
+				while length:
+					sent = os.sendfile (d.fileno (), f.fileno (), start, length)
+					if 0 == sent:
+						return
+					start += sent
+					length -= sent
+				return
+			except OSError:
+				pass
+
+		f.seek (start)
+		while length:
+			chunk = f.read (min (length, CHUNK))
+			if not chunk:
+				return
+			d.write (chunk)
+			length -= len (chunk)
+
 	with open (args[1], 'rb') as f:
+		#Reads mostly walk forward through the image, so ask for aggressive read ahead
+		if ADVISE:
+			os.posix_fadvise (f.fileno (), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+
 		f.seek (offset + ROOT)
 		size, lba, length, name_length, name, flags = read_dir (f)
 		print (f'{size} {lba} {length} {name_length} {name}')
@@ -73,8 +105,7 @@ def main (args):
 					#Dump file from image
 					print (depth*'  ' + f'  {name} : {lba} {length}')
 					with open (os.path.join (joined, name), 'wb') as d:
-						f.seek (offset + lba)
-						d.write (f.read (length))
+						copy (f, d, offset + lba, length)
 
 				#Advance to next record in the directory
 				f.seek (base + size)